@@ -1,4 +1,6 @@
-from .sendfile import send_file, format_ts
+from .sendfile import send_file, format_ts, SendfileBody
+from .sendfromzip import send_from_zip
 from .rangewrapper import range_iter, RangeWrapper
 
-__all__ = ['send_file', 'format_ts', 'range_iter', 'RangeWrapper']
+__all__ = ['send_file', 'format_ts', 'SendfileBody', 'send_from_zip',
+           'range_iter', 'RangeWrapper']
@@ -9,9 +9,44 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
 import io
+import zipfile
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-CHUNK = 1024 * 8
+
+CHUNK = 1024 * 64
+SEEK_BUFFER = 1024 * 1024
+SEEK_BUFFER_POOL_SIZE = 8
+
+_seek_buffers = queue.LifoQueue(maxsize=SEEK_BUFFER_POOL_SIZE)
+
+
+def get_seek_buffer():
+    """ Return a buffer of ``SEEK_BUFFER`` bytes from the pool
+
+    A new buffer is allocated if the pool is empty. The buffer should be
+    returned to the pool using ``put_seek_buffer()`` once it is no longer
+    used.
+    """
+    try:
+        return _seek_buffers.get_nowait()
+    except queue.Empty:
+        return bytearray(SEEK_BUFFER)
+
+
+def put_seek_buffer(buf):
+    """ Return a buffer to the pool
+
+    At most ``SEEK_BUFFER_POOL_SIZE`` buffers are kept in the pool, and any
+    buffers above that are discarded.
+    """
+    try:
+        _seek_buffers.put_nowait(buf)
+    except queue.Full:
+        pass
 
 
 def emulate_seek(fd, offset, chunk=CHUNK):
@@ -31,11 +66,37 @@ def emulate_seek(fd, offset, chunk=CHUNK):
     memory.
 
     Default chunk size is controlled by the ``fsend.rangewrapper.CHUNK``
-    constant, which is 8KB by default.
+    constant, which is 64KB by default.
+
+    If the file descriptor has a ``readinto()`` method, the ``chunk`` argument
+    is ignored. Instead, the discarded bytes are read into a single buffer of
+    ``SEEK_BUFFER`` bytes (1MB by default), so that no new objects are created
+    for each read. The buffers are taken from a pool shared by all seeks (see
+    ``get_seek_buffer()``), so they are not allocated for every seek either.
+    If the file descriptor also has a ``readinto1()`` method (e.g., buffered
+    streams such as ``zipfile.ZipExtFile``), it is used instead, which skips
+    the descriptor's own buffering of the discarded bytes. ``force_seek()``
+    uses this function for forward seeks within ``zipfile.ZipExtFile``
+    objects even when they have a ``seek()`` method.
 
     This function has no return value.
     """
-    while chunk and offset > CHUNK:
+    if hasattr(fd, 'readinto'):
+        readinto = getattr(fd, 'readinto1', fd.readinto)
+        pooled = get_seek_buffer()
+        buf = memoryview(pooled)
+        size = len(buf)
+        try:
+            while offset > 0:
+                read = readinto(buf if offset >= size else buf[:offset])
+                if not read:
+                    # Reached end of file before offset
+                    return
+                offset -= read
+        finally:
+            put_seek_buffer(pooled)
+        return
+    while chunk and offset > chunk:
         fd.read(chunk)
         offset -= chunk
     fd.read(offset)
@@ -48,9 +109,23 @@ def force_seek(fd, offset, chunk=CHUNK):
     specified by ``offset`` argument. If the descriptor does not support the
     ``seek()`` method, it will fall back to ``emulate_seek()``.
 
+    Members of ZIP archives (``zipfile.ZipExtFile``) have a ``seek()`` method
+    on Python 3.7 and newer, but it also reads and discards the data, and
+    allocates a new buffer of up to 16MB for each read. Forward seeks within
+    them are therefore done using ``emulate_seek()``.
+
     The optional ``chunk`` argument can be used to adjust the chunk size for
     ``emulate_seek()``.
     """
+    if isinstance(fd, zipfile.ZipExtFile):
+        try:
+            position = fd.tell()
+        except (AttributeError, io.UnsupportedOperation):
+            # No tell() before Python 3.7, nor seek(), so it's emulated
+            position = 0
+        if offset >= position:
+            emulate_seek(fd, offset - position, chunk)
+            return
     try:
         fd.seek(offset)
     except (AttributeError, io.UnsupportedOperation):
@@ -58,6 +133,27 @@ def force_seek(fd, offset, chunk=CHUNK):
         emulate_seek(fd, offset, chunk)
 
 
+def read_full(fd, size):
+    """ Read ``size`` bytes from the file descriptor
+
+    If the descriptor returns less data than requested (e.g., it is a pipe or
+    a stream that returns data in smaller pieces), it is read repeatedly until
+    ``size`` bytes are read or it is exhausted, and the pieces are joined
+    once at the end. The returned data is therefore shorter than ``size``
+    only if the descriptor has been exhausted.
+    """
+    data = fd.read(size)
+    parts = [data]
+    read = len(data)
+    while data and read < size:
+        data = fd.read(size - read)
+        parts.append(data)
+        read += len(data)
+    if len(parts) == 1:
+        return parts[0]
+    return parts[0][:0].join(parts)
+
+
 def range_iter(fd, offset, length, chunk=CHUNK):
     """ Iterator generator that iterates over chunks in specified range
 
@@ -71,16 +167,23 @@ def range_iter(fd, offset, length, chunk=CHUNK):
     method, or by using ``emulate_seek()`` function if file descriptor does not
     implement ``seek()``.
 
-    The file descriptor is automatically closed when iteration is finished.
+    The reads never go past the end of the range, and iteration stops as soon
+    as the whole range is read, so ranges that are not larger than ``chunk``
+    are read using a single read.
+
+    The file descriptor is automatically closed when iteration is finished,
+    or when the descriptor is exhausted before the end of the range.
     """
     force_seek(fd, offset, chunk)
-    while length > 0:
-        ret = fd.read(chunk)
-        if not ret:
-            return
-        length -= chunk
-        yield ret
-    fd.close()
+    try:
+        while length > 0:
+            ret = fd.read(min(chunk, length))
+            if not ret:
+                return
+            length -= len(ret)
+            yield ret
+    finally:
+        fd.close()
 
 
 class RangeWrapper(object):
@@ -121,8 +224,21 @@ class RangeWrapper(object):
         self.fd = fd
         self.offset = offset
         self.remaining = length
+        self.buffer = None
         force_seek(self.fd, self.offset, self.chunk)
 
+    def prefetch(self):
+        """ Read the first chunk of the range in advance
+
+        The chunk (of ``chunk`` bytes) is kept in memory and returned by the
+        subsequent reads before any more data is read from the file
+        descriptor. This allows the response to be constructed with data that
+        is ready to be sent along with the response headers, and errors in
+        reading the file descriptor to surface before the response is
+        returned. This method should be called before any reads.
+        """
+        self.buffer = self.read(self.chunk)
+
     def read(self, size=None):
         """ Read a specified number of bytes from the file descriptor
 
@@ -132,22 +248,40 @@ class RangeWrapper(object):
         If file descriptor is not present (e.g., ``close()`` method had been
         called), ``ValueError`` is raised.
 
-        If ``size`` is omitted, or ``None``, or any other falsy value, read
-        will be done up to the remaining length (constructor's ``length``
-        argument minus the bytes that have been read previously).
+        If ``size`` is omitted, or ``None``, negative, or any other falsy
+        value, read will be done up to the remaining length (constructor's
+        ``length`` argument minus the bytes that have been read previously).
 
         This method internally invokes the file descriptor's ``read()`` method,
-        and the method must accept a single integer positional argument.
+        and the method must accept a single integer positional argument. If
+        the descriptor returns less data than requested, it is read repeatedly
+        using ``read_full()``.
+
+        Data that was read in advance by ``prefetch()`` is returned first.
         """
         if not self.fd:
             raise ValueError('I/O on closed file')
+        if size is not None and size < 0:
+            size = None
+        prefix = self.buffer
+        if prefix:
+            if size and size < len(prefix):
+                self.buffer = prefix[size:]
+                return prefix[:size]
+            self.buffer = None
+            if size == len(prefix):
+                return prefix
+            if size:
+                size -= len(prefix)
         if not size:
             size = self.remaining
         size = min([self.remaining, size])
         if not size:
-            return ''
-        data = self.fd.read(size)
-        self.remaining -= size
+            return prefix or ''
+        data = read_full(self.fd, size)
+        self.remaining -= len(data)
+        if prefix:
+            return prefix + data
         return data
 
     def close(self):
@@ -165,3 +299,82 @@ class RangeWrapper(object):
         except AttributeError:
             pass
         self.fd = None
+        self.buffer = None
+
+
+class FileSlice(object):
+    """ File-like object that represents a region of a file
+
+    This class is used to serve a part of a larger file as if it were a file
+    of its own (e.g., uncompressed member of a ZIP archive). The reads are
+    confined to the region, and ``seek()`` and ``tell()`` are relative to the
+    region's start.
+
+    Because the class exposes the ``fileno()`` method of the underlying file,
+    and the underlying file's position always matches the slice's position,
+    WSGI servers that support ``wsgi.file_wrapper`` can serve it using
+    ``sendfile(2)``.
+    """
+
+    def __init__(self, fd, start, size):
+        """
+        The ``fd`` argument is a file object which supports ``seek()``. For
+        ``sendfile(2)`` to work, it should be unbuffered. ``start`` is the
+        offset of the region within the file, and ``size`` is
+        the size of the region in bytes. The file is positioned at the start
+        of the region upon initialization.
+        """
+        self.fd = fd
+        self.start = start
+        self.size = size
+        self.position = 0
+        self.fd.seek(start)
+
+    def fileno(self):
+        """ Return the file number of the underlying file """
+        return self.fd.fileno()
+
+    def seekable(self):
+        """ Return ``True``, as the region can always be seeked """
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """ Move to ``offset`` bytes relative to position given by ``whence``
+
+        The ``whence`` argument has the same meaning as in ``seek()`` of file
+        objects, except that the start and end are those of the region.
+        Positions outside the region are treated as start or end of the
+        region. The new position relative to the start of the region is
+        returned.
+        """
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence ({}, should be 0, 1 or 2)'.format(
+                whence))
+        self.position = max(0, min(offset, self.size))
+        self.fd.seek(self.start + self.position)
+        return self.position
+
+    def tell(self):
+        """ Return the current position relative to the start of the region """
+        return self.position
+
+    def read(self, size=None):
+        """ Read at most ``size`` bytes without going past end of the region
+
+        If ``size`` is omitted, ``None``, or negative, the rest of the region
+        is read.
+        """
+        remaining = self.size - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.fd.read(size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        """ Close the underlying file """
+        self.fd.close()
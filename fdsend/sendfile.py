@@ -8,19 +8,44 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
+import io
+import os
 import time
 import mimetypes
 
 from bottle import (HTTPResponse, HTTPError, parse_date, parse_range_header,
                     request)
 
-from .rangewrapper import range_iter
+from .rangewrapper import range_iter, read_full, RangeWrapper
 
 
 CHARSET = 'UTF-8'
-TIMESTAMP_FMT = '%a, %d %b %Y %H:%M:%S GMT'
+TIMESTAMP_FMT = '%s, %02d %s %04d %02d:%02d:%02d GMT'
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+          'Oct', 'Nov', 'Dec')
+TIMESTAMP_CACHE_SIZE = 1024
+MIMETYPE_CACHE_SIZE = 1024
+SMALL_FILE_SIZE = 1024 * 64
 DEFAULT_WRAPPER = range_iter
 
+_timestamp_cache = {}
+_mimetype_cache = {}
+_date_now = (None, None)
+
+
+def _format_ts(seconds):
+    year, month, day, hour, minute, sec, wday = time.gmtime(seconds)[:7]
+    return TIMESTAMP_FMT % (WEEKDAYS[wday], day, MONTHS[month - 1], year,
+                            hour, minute, sec)
+
+
+def _close(fd):
+    try:
+        fd.close()
+    except AttributeError:
+        pass
+
 
 def format_ts(seconds=None):
     """ Format timestamp expressed as seconds from epoch in RFC format
@@ -29,8 +54,136 @@ def format_ts(seconds=None):
 
     If the ``seconds`` argument is omitted, or is ``None``, the current time is
     used.
+
+    Day and month names are always in English as required by the standard,
+    regardless of the locale.
+
+    Formatted timestamps are cached, as the same timestamps (e.g., file
+    modification times) tend to be formatted over and over. The cache holds
+    up to ``TIMESTAMP_CACHE_SIZE`` timestamps, and is emptied when full.
+    """
+    if seconds is None:
+        return _format_ts(None)
+    seconds = int(seconds)
+    try:
+        return _timestamp_cache[seconds]
+    except KeyError:
+        pass
+    if len(_timestamp_cache) >= TIMESTAMP_CACHE_SIZE:
+        _timestamp_cache.clear()
+    ret = _timestamp_cache[seconds] = _format_ts(seconds)
+    return ret
+
+
+def date_now():
+    """ Format current time in RFC format for use in the Date header
+
+    The formatted time is reused until the current second elapses, so the
+    formatting is done at most once per second.
+    """
+    global _date_now
+    now = int(time.time())
+    seconds, ret = _date_now
+    if seconds != now:
+        ret = _format_ts(now)
+        _date_now = (now, ret)
+    return ret
+
+
+def guess_type(filename):
+    """ Guess content type and encoding of a file based on its file name
+
+    This function returns the same value as ``mimetypes.guess_type()``, but
+    the values are cached by file extension, so the lookup is only done once
+    for each extension. The cache holds up to ``MIMETYPE_CACHE_SIZE``
+    extensions, and is emptied when full.
+    """
+    root, ext = os.path.splitext(filename)
+    if ext in mimetypes.suffix_map or ext in mimetypes.encodings_map or \
+            ext.lower() in mimetypes.encodings_map:
+        # Extensions such as '.gz' only determine the encoding, and type is
+        # determined by the extension preceding it (e.g., '.tar.gz')
+        ext = os.path.splitext(root)[1] + ext
+    try:
+        return _mimetype_cache[ext]
+    except KeyError:
+        pass
+    if len(_mimetype_cache) >= MIMETYPE_CACHE_SIZE:
+        _mimetype_cache.clear()
+    # Extension is prefixed so it is not mistaken for a dotfile name
+    ret = _mimetype_cache[ext] = mimetypes.guess_type('file' + ext)
+    return ret
+
+
+def not_modified(timestamp, environ):
+    """ Return whether the file has not been modified since the time given in
+    the If-Modified-Since header of the request
+
+    The ``timestamp`` is file's modification time in seconds since Unix epoch,
+    and ``environ`` is the request's WSGI environment. The header has a
+    resolution of one second, so fractions of a second in the timestamp are
+    disregarded. If there is no such header, ``False`` is returned.
+    """
+    modsince = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if not modsince:
+        return False
+    modsince = parse_date(modsince.split(';', 1)[0].strip())
+    return modsince is not None and modsince >= int(timestamp)
+
+
+class SendfileBody(RangeWrapper):
+    """ Range wrapper which allows the server to use ``sendfile(2)``
+
+    This wrapper works like ``fdsend.rangewrapper.RangeWrapper``, but it also
+    exposes the ``fileno()`` method of the underlying file descriptor. Since
+    it is a file-like object, bottle passes it to ``wsgi.file_wrapper`` when
+    the WSGI server provides one, and servers such as gunicorn and uWSGI will
+    then send the range straight from the file descriptor using
+    ``sendfile(2)`` instead of reading it in Python. The read cursor is placed
+    at the range offset by the constructor, and the range length is taken from
+    the Content-Length header, so no copying happens in user space.
+
+    On servers without ``wsgi.file_wrapper`` the body is read using the
+    ``read()`` method, and behaves exactly like ``RangeWrapper``.
     """
-    return time.strftime(TIMESTAMP_FMT, time.gmtime(seconds))
+
+    def fileno(self):
+        """ Return the file number of the underlying file descriptor """
+        return self.fd.fileno()
+
+    def prefetch(self):
+        """ Do nothing, as reading in advance would move the descriptor's
+        position past the range start from which ``sendfile(2)`` sends """
+
+    def __iter__(self):
+        read = self.read
+        chunk = read(self.chunk)
+        while chunk:
+            yield chunk
+            chunk = read(self.chunk)
+
+
+def can_sendfile(fd):
+    """ Return whether the file descriptor can be served using ``sendfile(2)``
+
+    The ``fd`` must be backed by a real file (its ``fileno()`` method returns
+    an integer), and the request must be a plain HTTP/1.x request. Over TLS or
+    HTTP/2 the server has to transform the payload before it hits the socket,
+    so ``sendfile(2)`` cannot be used.
+    """
+    try:
+        fileno = fd.fileno()
+    except (AttributeError, ValueError, io.UnsupportedOperation):
+        # No file number (in-memory file, ZIP member) or file is closed
+        return False
+    if not isinstance(fileno, int):
+        return False
+    environ = request.environ
+    if environ.get('wsgi.url_scheme') == 'https':
+        return False
+    if environ.get('SERVER_PROTOCOL', '').startswith('HTTP/2'):
+        return False
+    return True
 
 
 def send_file(fd, filename=None, size=None, timestamp=None, ctype=None,
@@ -42,6 +195,8 @@ def send_file(fd, filename=None, size=None, timestamp=None, ctype=None,
     must have a ``read()`` method. ``ValueError`` is raised when this is not
     the case. It supports `byte serving`_ using Range header, and makes the
     best effort to set all appropriate headers. It also supports HEAD queries.
+    The file descriptor is closed right away if the response has no body (HEAD
+    requests, HTTP 304 and HTTP 416 responses).
 
     Because we are dealing with file descriptors and not physical files, the
     user must also supply the file metadata such as filename, size, and
@@ -54,6 +209,12 @@ def send_file(fd, filename=None, size=None, timestamp=None, ctype=None,
     The ``size`` argument is the payload size in bytes. If it is omitted, the
     content length header is not set, and byte serving does not work.
 
+    When the size is known and is not larger than ``SMALL_FILE_SIZE`` (64KB
+    by default), and the whole file is requested, the file is read and closed
+    right away, and its contents are used as the response body. If fewer than
+    ``size`` bytes can be read, the content length is set to the number of
+    bytes that were read.
+
     The ``timestamp`` argument is the number of seconds since Unix epoch when
     the file was created or last modified. If this argument is omitted,
     If-Modified-Since request headers cannot be honored.
@@ -69,11 +230,12 @@ def send_file(fd, filename=None, size=None, timestamp=None, ctype=None,
     filename.
 
     The ``wrapper`` argument is used to wrap the file descriptor when doing
-    byte serving. The default is to use ``fdsend.rangewrapper.RangeWrapper``
-    class, but there are alternatives as ``fdsend.rangewrapper.range_iter`` and
-    ``bottle._file_iter_range``. The wrappers provided by this package are
-    written to specifically handle file handles that do not have a ``seek()``
-    method. If this is not your case, you may safely use the bottle's wrapper.
+    byte serving. The default is to use ``fdsend.rangewrapper.range_iter``
+    function, but there are alternatives as
+    ``fdsend.rangewrapper.RangeWrapper`` and ``bottle._file_iter_range``. The
+    wrappers provided by this package are written to specifically handle file
+    handles that do not have a ``seek()`` method. If this is not your case,
+    you may safely use the bottle's wrapper.
 
     The primary difference between ``fdsend.rangewrapper.RangeWrapper`` and
     ``fdsend.rangewrapper.range_iter`` is that the former returns a file-like
@@ -83,6 +245,11 @@ def send_file(fd, filename=None, size=None, timestamp=None, ctype=None,
     use of a ``file_wrapper``. This may have some benefits when it comes to
     memory usage.
 
+    When the default wrapper is used and the file descriptor is backed by a
+    real file (see ``can_sendfile()``), ``SendfileBody`` is used instead, so
+    that WSGI servers which support ``wsgi.file_wrapper`` can serve the range
+    using ``sendfile(2)``.
+
     Benchmarking and profiling is the best way to determine which wrapper you
     want to use, or you need to implement your own.
 
@@ -93,6 +260,10 @@ def send_file(fd, filename=None, size=None, timestamp=None, ctype=None,
     - offset (in bytes from start of the file)
     - length (total number of bytes in the range)
 
+    The wrapper is not used when the requested range covers the entire file.
+    If the object returned by the wrapper has a ``prefetch()`` method (like
+    ``RangeWrapper`` does), it is called before the response is returned.
+
     The return value of the wrapper must be either an iterable or file-like
     object that implements ``read()`` and ``close()`` methods with the usual
     semantics.
@@ -104,11 +275,13 @@ def send_file(fd, filename=None, size=None, timestamp=None, ctype=None,
     if not hasattr(fd, 'read'):
         raise ValueError("Object '{}' has no read() method".format(fd))
 
+    # Request's environ is looked up in thread-local storage on each access
+    environ = request.environ
     headers = {}
     status = 200
 
     if not ctype and filename is not None:
-        ctype, enc = mimetypes.guess_type(filename)
+        ctype, enc = guess_type(filename)
         if enc:
             headers['Content-Encoding'] = enc
 
@@ -123,34 +296,54 @@ def send_file(fd, filename=None, size=None, timestamp=None, ctype=None,
         headers['Content-Length'] = size
         headers['Accept-Ranges'] = 'bytes'
 
-    if timestamp:
+    if timestamp is not None:
         headers['Last-Modified'] = format_ts(timestamp)
 
-        # Check if If-Modified-Since header is in request and respond early
-        modsince = request.environ.get('HTTP_IF_MODIFIED_SINCE')
-        print(modsince)
-        modsince = modsince and parse_date(modsince.split(';')[0].strip())
-        if modsince is not None and modsince >= timestamp:
-            headers['Date'] = format_ts()
+        # Check if If-Modified-Since header is in request and respond early.
+        if not_modified(timestamp, environ):
+            headers['Date'] = date_now()
+            _close(fd)
             return HTTPResponse(status=304, **headers)
 
     if attachment and filename:
         headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
 
-    if request.method == 'HEAD':
+    ranges = environ.get('HTTP_RANGE')
+    head = request.method == 'HEAD'
+    if head:
         # Request is a HEAD, so remove any fd body
+        _close(fd)
         fd = ''
+    elif size and size <= SMALL_FILE_SIZE and not ranges:
+        # Small files are read in whole, so the server can send them in a
+        # single write instead of iterating over the file descriptor
+        # Descriptor may return less data than its declared size (e.g., a
+        # pipe, or the file is smaller than expected)
+        data = read_full(fd, size)
+        _close(fd)
+        fd = data
+        headers['Content-Length'] = len(data)
 
-    ranges = request.environ.get('HTTP_RANGE')
     if size and ranges:
         ranges = list(parse_range_header(ranges, size))
         if not ranges:
+            _close(fd)
             return HTTPError(416, 'Request Range Not Satisfiable')
         start, end = ranges[0]
         headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
         length = end - start
         headers['Content-Length'] = str(length)
-        fd = wrapper(fd, start, length)
+        if length < size and not head:
+            # When entire file is requested (e.g., 'bytes=0-'), the file
+            # descriptor is used as is, as there is no range to confine
+            # the reads to.
+            if wrapper is DEFAULT_WRAPPER and can_sendfile(fd):
+                wrapper = SendfileBody
+            fd = wrapper(fd, start, length)
+            prefetch = getattr(fd, 'prefetch', None)
+            if prefetch:
+                # Have the first chunk ready to be sent with the headers
+                prefetch()
         status = 206
 
     return HTTPResponse(fd, status=status, **headers)
@@ -0,0 +1,458 @@
+"""
+sendfromzip.py: functions for sending files stored in ZIP archives
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import atexit
+import shutil
+import struct
+import zipfile
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from bottle import HTTPError, parse_range_header, request
+
+from .sendfile import send_file, not_modified, CHARSET, DEFAULT_WRAPPER
+from .rangewrapper import FileSlice
+
+
+ZIP_CACHE_SIZE = 32
+SPILL_CACHE_SIZE = 16
+SPILL_THRESHOLD = 1024 * 1024
+SPILL_DIR = None
+SPILL_CHUNK = 1024 * 1024
+
+
+class LRUCache(object):
+    """ Thread-safe cache that keeps a limited number of most recently used
+    values
+
+    When the number of values in the cache exceeds ``maxsize``, least recently
+    used values are removed from the cache and passed to the ``on_evict``
+    callable (if one is specified), so that any resources held by them can be
+    released.
+
+    Values can be marked as in use by obtaining them using ``acquire()``
+    instead of ``get()``. Such values are only passed to ``on_evict`` once
+    they have been removed from the cache, and released as many times as they
+    were acquired using ``release()``.
+    """
+
+    def __init__(self, maxsize, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        # Number of users of acquired values, by value identity
+        self.users = {}
+        # Values removed from the cache that are still in use
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return value stored under ``key`` and mark it as recently used
+
+        If there is no such key, ``default`` is returned.
+        """
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+
+    def acquire(self, key, default=None):
+        """ Return value stored under ``key`` and mark it as in use
+
+        The value must be released using ``release()`` once it is no longer
+        used. If there is no such key, ``default`` is returned, and nothing
+        needs to be released.
+        """
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            self._use(value)
+            return value
+
+    def release(self, value):
+        """ Mark a value obtained using ``acquire()`` as no longer used
+
+        If the value has been removed from the cache in the mean time, and
+        this was its last user, it is evicted.
+        """
+        with self.lock:
+            users = self.users[id(value)] - 1
+            if users:
+                self.users[id(value)] = users
+                return
+            del self.users[id(value)]
+            value = self.pending.pop(id(value), None)
+        if value is not None:
+            self.evict(value)
+
+    def add(self, key, value, acquire=False):
+        """ Store value under ``key`` and return the value stored in the cache
+
+        If another value has been stored under the same key in the mean time
+        (e.g., by another thread), the cached value is kept and returned, and
+        the ``value`` argument is evicted instead. If ``acquire`` is ``True``,
+        the returned value is marked as in use, as with ``acquire()``.
+        """
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                evicted.append(value)
+                value = self.entries[key]
+            else:
+                self.entries[key] = value
+                while len(self.entries) > self.maxsize:
+                    self._remove(self.entries.popitem(last=False)[1], evicted)
+            if acquire:
+                self._use(value)
+        for old in evicted:
+            self.evict(old)
+        return value
+
+    def clear(self):
+        """ Remove all values from the cache
+
+        Values that are not in use are evicted right away, and the remaining
+        ones once they are released.
+        """
+        evicted = []
+        with self.lock:
+            for old in self.entries.values():
+                self._remove(old, evicted)
+            self.entries.clear()
+        for old in evicted:
+            self.evict(old)
+
+    def evict(self, value):
+        if self.on_evict:
+            self.on_evict(value)
+
+    def _use(self, value):
+        self.users[id(value)] = self.users.get(id(value), 0) + 1
+
+    def _remove(self, value, evicted):
+        if id(value) in self.users:
+            self.pending[id(value)] = value
+        else:
+            evicted.append(value)
+
+
+_zip_cache = LRUCache(ZIP_CACHE_SIZE, on_evict=lambda zfile: zfile.close())
+
+
+def open_zip(zippath):
+    """ Return a ``ZipFile`` object for archive at ``zippath`` and archive's
+    modification time
+
+    Opening a ZIP archive involves parsing its entire central directory, so
+    the opened archives are kept in a cache of ``ZIP_CACHE_SIZE`` most
+    recently used archives. The cache is keyed by path, modification time and
+    inode number of the archive, so a modified or replaced archive is opened
+    anew. The modification time is obtained while looking up the cache, so
+    that callers do not need to stat the archive again.
+
+    The returned archive is marked as in use, and it must be released using
+    ``release_zip()`` once the caller no longer needs it. Archives that drop
+    out of the cache are closed once they are released by all callers. This
+    does not affect files that are still being read from them, as the
+    archive file is only closed once all of its open members are closed.
+    """
+    st = os.stat(zippath)
+    key = (zippath, st.st_mtime, st.st_ino)
+    zfile = _zip_cache.acquire(key)
+    if zfile is None:
+        zfile = _zip_cache.add(key, zipfile.ZipFile(zippath), acquire=True)
+    return zfile, st.st_mtime
+
+
+def release_zip(zfile):
+    """ Release archive obtained using ``open_zip()`` """
+    _zip_cache.release(zfile)
+
+
+def open_stored(zippath, zinfo):
+    """ Return a ``FileSlice`` object for uncompressed archive member
+
+    The archive member described by ``zinfo`` must be stored without
+    compression, which means its contents are stored in the archive as is.
+    The returned object reads the contents directly from the archive file,
+    and has a ``fileno()`` method, so that the contents can be served using
+    ``sendfile(2)``. Note that the CRC of the contents is not verified.
+
+    The position of the contents is determined by reading the member's local
+    file header. If the header is not valid, ``None`` is returned.
+    """
+    # The file is unbuffered, so that its position as seen by the OS (and
+    # sendfile(2)) is always the same as the position of the file object
+    fd = open(zippath, 'rb', 0)
+    fd.seek(zinfo.header_offset)
+    header = fd.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or \
+            header[:4] != zipfile.stringFileHeader:
+        fd.close()
+        return None
+    # File name and extra field lengths are the last two fields of the header
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    start = zinfo.header_offset + zipfile.sizeFileHeader + name_len + extra_len
+    return FileSlice(fd, start, zinfo.file_size)
+
+
+def remove_spill(path):
+    """ Remove spill file at ``path``, ignoring files that no longer exist """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+_spill_cache = LRUCache(SPILL_CACHE_SIZE, on_evict=remove_spill)
+atexit.register(_spill_cache.clear)
+# Locks of members that are being spilled, with number of threads using them
+_spill_locks = {}
+_spill_locks_lock = threading.Lock()
+
+
+def acquire_spill_lock(key):
+    """ Acquire the lock for spilling archive member identified by ``key``
+
+    While one thread holds the lock, other threads that want to spill the
+    same member wait for it, and then use the spill file it created, so that
+    simultaneous requests for the same member do not each decompress it. The
+    lock must be released using ``release_spill_lock()``.
+    """
+    with _spill_locks_lock:
+        entry = _spill_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    entry[0].acquire()
+
+
+def release_spill_lock(key):
+    """ Release the lock acquired using ``acquire_spill_lock()``
+
+    The lock is discarded once no thread is using it.
+    """
+    with _spill_locks_lock:
+        entry = _spill_locks[key]
+        entry[0].release()
+        entry[1] -= 1
+        if not entry[1]:
+            del _spill_locks[key]
+
+
+def spill(zfile, zinfo):
+    """ Decompress archive member into a temporary file and return its path
+
+    The file is created in ``SPILL_DIR`` directory, or in the default
+    temporary directory if ``SPILL_DIR`` is ``None``.
+    """
+    fd, path = tempfile.mkstemp(prefix='fdsend-', dir=SPILL_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as dest:
+            src = zfile.open(zinfo)
+            try:
+                shutil.copyfileobj(src, dest, SPILL_CHUNK)
+            finally:
+                src.close()
+    except Exception:
+        remove_spill(path)
+        raise
+    return path
+
+
+def _open_spill_file(key):
+    path = _spill_cache.get(key)
+    if path is None:
+        return None
+    try:
+        return open(path, 'rb')
+    except (IOError, OSError):
+        # Spill file has been removed from the cache in the mean time
+        return None
+
+
+def open_spilled(zfile, zinfo):
+    """ Return a file object for decompressed copy of archive member
+
+    Compressed archive members cannot be seeked, so serving a range from the
+    middle of the member requires decompressing everything before it. To
+    avoid doing this for every range request (e.g., video players seeking
+    through a video), the member is decompressed into a spill file once, and
+    the spill file is used for subsequent requests. The returned file object
+    is backed by a real file, so ranges can be served using ``sendfile(2)``.
+
+    Spill files are kept for ``SPILL_CACHE_SIZE`` most recently used members,
+    and are removed when they drop out of the cache, or when the interpreter
+    exits. If several threads request the same member at once, only one of
+    them decompresses it, and the others wait for its spill file.
+    """
+    key = (zfile.filename, zinfo.filename, zinfo.header_offset, zinfo.CRC,
+           zinfo.file_size)
+    fd = _open_spill_file(key)
+    if fd is not None:
+        return fd
+    acquire_spill_lock(key)
+    try:
+        # Another thread may have spilled the member while we waited
+        fd = _open_spill_file(key)
+        if fd is not None:
+            return fd
+        path = _spill_cache.add(key, spill(zfile, zinfo))
+    finally:
+        release_spill_lock(key)
+    return open(path, 'rb')
+
+
+def range_requested(size, timestamp):
+    """ Return whether a part of the file will be sent in response to the
+    current request
+
+    This is the case when the request has a valid Range header that does not
+    cover the entire file of ``size`` bytes, the request method is not HEAD,
+    and the file has been modified since the time given in the
+    If-Modified-Since header (if any), using ``timestamp`` as the file's
+    modification time. Otherwise, ``send_file()`` does not read the range, so
+    there is no need for a spill file.
+    """
+    environ = request.environ
+    ranges = environ.get('HTTP_RANGE')
+    if not ranges or request.method == 'HEAD':
+        return False
+    if not_modified(timestamp, environ):
+        return False
+    ranges = list(parse_range_header(ranges, size))
+    return bool(ranges) and ranges[0] != (0, size)
+
+
+def _prefill_spills(zfile, paths, workers):
+    if paths is None:
+        zinfos = [zinfo for zinfo in zfile.infolist()
+                  if zinfo.file_size >= SPILL_THRESHOLD]
+    else:
+        zinfos = [zfile.getinfo(path) for path in paths]
+    zinfos = [zinfo for zinfo in zinfos
+              if zinfo.compress_type != zipfile.ZIP_STORED]
+    if paths is None:
+        zinfos.sort(key=lambda zinfo: zinfo.file_size, reverse=True)
+        zinfos = zinfos[:SPILL_CACHE_SIZE]
+
+    pending = queue.Queue()
+    for zinfo in zinfos:
+        pending.put(zinfo)
+    errors = []
+
+    def prefill():
+        while True:
+            try:
+                zinfo = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                open_spilled(zfile, zinfo).close()
+            except Exception as exc:
+                errors.append(exc)
+
+    workers = min(workers or multiprocessing.cpu_count(), len(zinfos))
+    threads = [threading.Thread(target=prefill) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def prefill_spills(zippath, paths=None, workers=None):
+    """ Decompress archive members into spill files in advance
+
+    This function can be used to decompress large compressed members of the
+    archive at ``zippath`` before they are requested, so that even the first
+    Range request for them is served from a spill file (see
+    ``open_spilled()``). The ``paths`` argument is an iterable of paths of
+    the members within the archive. If it is omitted, compressed members of
+    ``SPILL_THRESHOLD`` bytes or more are decompressed, up to
+    ``SPILL_CACHE_SIZE`` largest ones, as only that many spill files are kept
+    and any more would remove the ones created before them. Members stored
+    without compression are skipped, as they do not need spill files.
+
+    The members are decompressed in parallel by ``workers`` threads (by
+    default, one thread per CPU). Decompression is done by zlib, which does
+    not hold the interpreter lock while decompressing, so this uses multiple
+    CPU cores. Each member is still decompressed by a single thread, as
+    DEFLATE streams cannot be split at arbitrary offsets. If decompressing any
+    of the members fails, the first error is raised once all threads finish.
+    """
+    zfile, _ = open_zip(zippath)
+    try:
+        _prefill_spills(zfile, paths, workers)
+    finally:
+        release_zip(zfile)
+
+
+def send_from_zip(zippath, path, ctype=None, charset=CHARSET,
+                  attachment=False, wrapper=DEFAULT_WRAPPER):
+    """ Send a file stored in a ZIP archive
+
+    This function constructs a HTTPResponse object for a file at ``path``
+    within the ZIP archive at ``zippath``. The file name, size, and timestamp
+    (modification time of the archive) are passed to ``send_file()``, along
+    with the remaining arguments, which have the same meaning as in
+    ``send_file()``.
+
+    Files that are stored in the archive without compression are read
+    directly from the archive file (see ``open_stored()``), so they can be
+    served using ``sendfile(2)``. Range requests for compressed files of
+    ``SPILL_THRESHOLD`` bytes or more are served from a decompressed copy of
+    the file (see ``open_spilled()``), unless no part of the file is going to
+    be sent (see ``range_requested()``), or the decompressed copy cannot be
+    created.
+
+    If there is no file at ``path`` in the archive, HTTP 404 response is
+    returned.
+    """
+    zfile, timestamp = open_zip(zippath)
+    try:
+        try:
+            zinfo = zfile.getinfo(path)
+        except KeyError:
+            return HTTPError(404, 'Not Found')
+        fd = None
+        # Encrypted files must be decrypted, so only unencrypted ones qualify
+        if zinfo.compress_type == zipfile.ZIP_STORED and \
+                not zinfo.flag_bits & 1:
+            fd = open_stored(zippath, zinfo)
+        if fd is None and zinfo.file_size >= SPILL_THRESHOLD and \
+                range_requested(zinfo.file_size, timestamp):
+            try:
+                fd = open_spilled(zfile, zinfo)
+            except (IOError, OSError):
+                # Spill file could not be created (e.g., disk is full), so the
+                # range is read from the member itself
+                fd = None
+        if fd is None:
+            fd = zfile.open(zinfo)
+    finally:
+        # Opened member keeps the archive file open even if it is closed
+        release_zip(zfile)
+    return send_file(fd, filename=os.path.basename(path),
+                     size=zinfo.file_size, timestamp=timestamp, ctype=ctype,
+                     charset=charset, attachment=attachment, wrapper=wrapper)
@@ -9,6 +9,7 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
 import io
+import zipfile
 
 try:
     from unittest import mock
@@ -24,31 +25,33 @@ MOD = mod.__name__
 
 def test_emulate_seek():
     """
-    Given a file descriptor and offset, it reads the file in chunks of 8KB (by
+    Given a file descriptor and offset, it reads the file in chunks of 64KB (by
     default) until it reaches the offset.
     """
     fd = mock.Mock()
-    offset = 24576  # 24 KB, or 3 chunks of 8 KB (default chunk size)
+    del fd.readinto
+    offset = 3 * mod.CHUNK  # 3 chunks of default chunk size
     mod.emulate_seek(fd, offset)
     fd.read.assert_has_calls([
-        mock.call(8192),
-        mock.call(8192),
-        mock.call(8192),
+        mock.call(mod.CHUNK),
+        mock.call(mod.CHUNK),
+        mock.call(mod.CHUNK),
     ])
 
 
 def test_emulate_seek_last_remainder():
     """
     Given a file descriptor and offset that isn't a whole multiple of default
-    chunk size (8KB), last chunk read is smaller than the default chunk size.
+    chunk size (64KB), last chunk read is smaller than the default chunk size.
     """
     fd = mock.Mock()
-    offset = 24580  # 24 KB + 4 bytes
+    del fd.readinto
+    offset = 3 * mod.CHUNK + 4
     mod.emulate_seek(fd, offset)
     fd.read.assert_has_calls([
-        mock.call(8192),
-        mock.call(8192),
-        mock.call(8192),
+        mock.call(mod.CHUNK),
+        mock.call(mod.CHUNK),
+        mock.call(mod.CHUNK),
         mock.call(4),
     ])
 
@@ -58,9 +61,10 @@ def test_emulate_custom_chunk_size():
     Given a custom chunk size, it reads in chunks of specified size.
     """
     fd = mock.Mock()
+    del fd.readinto
     offset = 20
     mod.emulate_seek(fd, offset, chunk=10)
-    fd.read.asert_has_calls([
+    fd.read.assert_has_calls([
         mock.call(10),
         mock.call(10),
     ])
@@ -71,9 +75,10 @@ def test_emulate_no_chunking():
     Given chunk size of None, it reads entire offset at once.
     """
     fd = mock.Mock()
+    del fd.readinto
     offset = 20
     mod.emulate_seek(fd, offset, chunk=None)
-    fd.read.asert_called_once_with(20)
+    fd.read.assert_called_once_with(20)
 
 
 def test_emulate_zero_chunking():
@@ -81,9 +86,80 @@ def test_emulate_zero_chunking():
     Given chunk size of 0, it reads entire offset at once.
     """
     fd = mock.Mock()
+    del fd.readinto
     offset = 20
     mod.emulate_seek(fd, offset, chunk=0)
-    fd.read.asert_called_once_with(20)
+    fd.read.assert_called_once_with(20)
+
+
+class ReadintoOnly(object):
+    """ File-like object that only has readinto() method """
+
+    def __init__(self, data):
+        self.fd = io.BytesIO(data)
+        self.readinto = mock.Mock(wraps=self.fd.readinto)
+
+
+def test_emulate_seek_readinto():
+    """
+    Given a file descriptor with readinto() method, it reads into a single
+    buffer until offset is reached.
+    """
+    fd = ReadintoOnly(b'x' * (3 * mod.SEEK_BUFFER + 4))
+    mod.emulate_seek(fd, 2 * mod.SEEK_BUFFER + 4)
+    assert fd.fd.tell() == 2 * mod.SEEK_BUFFER + 4
+    assert fd.readinto.call_count == 3
+    buffers = [c[0][0].obj for c in fd.readinto.call_args_list]
+    assert buffers[0] is buffers[1] is buffers[2]
+
+
+def test_emulate_seek_readinto1():
+    """
+    Given a file descriptor with both readinto() and readinto1() methods,
+    readinto1() is used.
+    """
+    fd = io.BytesIO(b'x' * 100)
+    fd.readinto = mock.Mock(wraps=fd.readinto)
+    fd.readinto1 = mock.Mock(wraps=fd.readinto1)
+    mod.emulate_seek(fd, 20)
+    assert fd.tell() == 20
+    fd.readinto1.assert_called_once_with(mock.ANY)
+    assert not fd.readinto.called
+
+
+def test_emulate_seek_readinto_past_eof():
+    """
+    Given a file descriptor with readinto() method and offset past end of
+    file, it stops reading when file is exhausted.
+    """
+    fd = io.BytesIO(b'x' * 20)
+    mod.emulate_seek(fd, 100)
+    assert fd.tell() == 20
+
+
+def test_emulate_seek_reuses_buffer():
+    """
+    Given multiple seeks, the buffer used by the first seek is returned to the
+    pool and used by the next seek.
+    """
+    fd = ReadintoOnly(b'x' * 100)
+    mod.emulate_seek(fd, 20)
+    mod.emulate_seek(fd, 20)
+    first, second = [c[0][0].obj for c in fd.readinto.call_args_list]
+    assert first is second
+
+
+def test_seek_buffer_pool_size():
+    """
+    Given more buffers than the pool can hold, put_seek_buffer() discards
+    the excess buffers.
+    """
+    buffers = [mod.get_seek_buffer()
+               for _ in range(mod.SEEK_BUFFER_POOL_SIZE + 2)]
+    for buf in buffers:
+        assert len(buf) == mod.SEEK_BUFFER
+        mod.put_seek_buffer(buf)
+    assert mod._seek_buffers.qsize() == mod.SEEK_BUFFER_POOL_SIZE
 
 
 def test_force_seek():
@@ -119,20 +195,84 @@ def test_force_seek_with_unsupported_seek(emulate_seek):
     emulate_seek.assert_called_once_with(fd, 100, mod.CHUNK)
 
 
+def test_force_seek_zip_member(tmpdir):
+    """
+    Given a compressed ZIP archive member, forward seek is done using
+    emulate_seek(), and backward seek using the member's seek().
+    """
+    path = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('foo.txt', b'0123456789')
+    with zipfile.ZipFile(path) as z:
+        fd = z.open('foo.txt')
+        with mock.patch(MOD + '.emulate_seek',
+                        wraps=mod.emulate_seek) as emulate_seek:
+            mod.force_seek(fd, 6)
+        emulate_seek.assert_called_once_with(fd, 6, mod.CHUNK)
+        assert fd.read(2) == b'67'
+        mod.force_seek(fd, 2)
+        assert fd.read(2) == b'23'
+        fd.close()
+
+
+def test_read_full():
+    """
+    Given a file descriptor that returns less data than requested, read_full()
+    reads it until the size is reached or the descriptor is exhausted.
+    """
+    fd = mock.Mock()
+    fd.read.side_effect = [b'ab', b'cd', b'e']
+    assert mod.read_full(fd, 5) == b'abcde'
+    fd.read.assert_has_calls([mock.call(5), mock.call(3), mock.call(1)])
+    fd.read.side_effect = [b'ab', b'']
+    assert mod.read_full(fd, 5) == b'ab'
+
+
 def test_range_iter():
     """
     Given a file descript, offset, and length, retruns an iterator that reads
-    from the descriptor in chunks of 8 KB (by default).
+    from the descriptor in chunks of 64 KB (by default).
     """
     fd = mock.Mock()
+    fd.read.side_effect = lambda size: b'x' * size
     offset = 20
-    length = 24576  # 3 chunks of 8 KB
+    length = 3 * mod.CHUNK
     calls = []
     for chunk in mod.range_iter(fd, offset, length):
-        calls.append(mock.call(8192))
+        calls.append(mock.call(mod.CHUNK))
         fd.read.assert_has_calls(calls)
-        assert chunk == fd.read.return_value
+        assert chunk == b'x' * mod.CHUNK
     fd.seek.assert_called_once_with(offset)
+    assert fd.read.call_count == 3
+
+
+def test_range_iter_last_chunk():
+    """
+    Given length that isn't a whole multiple of chunk size, the last read is
+    limited to the remainder of the range, and no further reads are done.
+    """
+    fd = mock.Mock()
+    fd.read.side_effect = lambda size: b'x' * size
+    length = 2 * mod.CHUNK + 4
+    ret = list(mod.range_iter(fd, 20, length))
+    assert ret[-1] == b'xxxx'
+    assert fd.read.call_args_list == [
+        mock.call(mod.CHUNK),
+        mock.call(mod.CHUNK),
+        mock.call(4),
+    ]
+
+
+def test_range_iter_small_range():
+    """
+    Given length that is not larger than chunk size, it reads the entire range
+    at once.
+    """
+    fd = mock.Mock()
+    fd.read.return_value = b'x' * 30
+    ret = list(mod.range_iter(fd, 20, 30))
+    fd.read.assert_called_once_with(30)
+    assert ret == [fd.read.return_value]
 
 
 def test_range_iter_closes_fd():
@@ -141,6 +281,7 @@ def test_range_iter_closes_fd():
     handle is closed.
     """
     fd = mock.Mock()
+    fd.read.return_value = b'x' * 30
     list(mod.range_iter(fd, 20, 30))
     assert fd.close.called
 
@@ -155,6 +296,7 @@ def test_range_iter_interruption():
     length = 3 * mod.CHUNK  # should read 3 chunks
     ret = list(mod.range_iter(fd, 0, length))
     assert len(ret) == 2
+    assert fd.close.called
 
 
 def test_range_iter_support_fd_with_no_seek():
@@ -163,6 +305,8 @@ def test_range_iter_support_fd_with_no_seek():
     correct number of chunks reguardless.
     """
     fd = mock.Mock()
+    del fd.readinto
+    fd.read.side_effect = lambda size: b'x' * size
     fd.seek.side_effect = io.UnsupportedOperation
     length = 3 * mod.CHUNK
     ret = list(mod.range_iter(fd, 20, length))
@@ -245,6 +389,7 @@ def test_range_wrapper_read_without_size():
     as argument and data read from descriptor is returned.
     """
     fd = mock.Mock()
+    fd.read.return_value = b'x' * 20
     offset = length = 20
     ret = mod.RangeWrapper(fd, offset, length)
     data = ret.read()
@@ -259,6 +404,7 @@ def test_range_wrapper_read_with_size():
     specified size.
     """
     fd = mock.Mock()
+    fd.read.return_value = b'x' * 10
     offset = length = 20
     ret = mod.RangeWrapper(fd, offset, length)
     ret.read(10)
@@ -273,6 +419,7 @@ def test_range_wrapper_multiple_reads():
     method returns empty string once that limit is reached.
     """
     fd = mock.Mock()
+    fd.read.return_value = b'x' * 10
     offset = length = 20
     ret = mod.RangeWrapper(fd, offset, length)
     data = ret.read(10)
@@ -287,3 +434,153 @@ def test_range_wrapper_multiple_reads():
         mock.call(10),
         mock.call(10)
     ])
+
+
+def test_range_wrapper_read_short_reads():
+    """
+    Given file descriptor that returns less data than requested, when calling
+    read(), file descriptor's read() method is invoked until requested size is
+    read, and the pieces are returned joined.
+    """
+    fd = mock.Mock()
+    fd.read.side_effect = [b'abc', b'de', b'fghij']
+    offset = length = 20
+    ret = mod.RangeWrapper(fd, offset, length)
+    assert ret.read(10) == b'abcdefghij'
+    fd.read.assert_has_calls([
+        mock.call(10),
+        mock.call(7),
+        mock.call(5),
+    ])
+    assert ret.remaining == 10
+
+
+def test_range_wrapper_read_exhausted():
+    """
+    Given file descriptor that is exhausted before requested size is read,
+    when calling read(), the data read so far is returned.
+    """
+    fd = mock.Mock()
+    fd.read.side_effect = [b'abc', b'']
+    offset = length = 20
+    ret = mod.RangeWrapper(fd, offset, length)
+    assert ret.read(10) == b'abc'
+    assert fd.read.call_count == 2
+
+
+def test_file_slice():
+    """
+    Given a file descriptor, start offset, and size, returns a file-like
+    object that reads only the specified region of the file.
+    """
+    fd = io.BytesIO(b'0123456789')
+    ret = mod.FileSlice(fd, 2, 5)
+    assert ret.read(3) == b'234'
+    assert ret.tell() == 3
+    assert ret.read() == b'56'
+    assert ret.read() == b''
+
+
+def test_file_slice_seek():
+    """
+    Given a file slice, seek() is relative to the start of the region, and
+    positions past end of region are treated as end of region.
+    """
+    fd = io.BytesIO(b'0123456789')
+    ret = mod.FileSlice(fd, 2, 5)
+    ret.seek(2)
+    assert fd.tell() == 4
+    assert ret.read(10) == b'456'
+    ret.seek(20)
+    assert ret.tell() == 5
+    assert ret.read() == b''
+
+
+def test_file_slice_seek_whence():
+    """
+    Given a file slice, seek() with whence argument is relative to current
+    position or end of region, and returns the new position.
+    """
+    fd = io.BytesIO(b'0123456789')
+    ret = mod.FileSlice(fd, 2, 5)
+    assert ret.seekable()
+    assert ret.seek(0, 2) == 5
+    assert ret.tell() == 5
+    assert fd.tell() == 7
+    assert ret.seek(-2, 1) == 3
+    assert ret.read() == b'56'
+    assert ret.seek(-10, io.SEEK_END) == 0
+    assert ret.read(1) == b'2'
+
+
+def test_file_slice_fileno_and_close():
+    """
+    Given a file slice, fileno() and close() are delegated to the file
+    descriptor.
+    """
+    fd = mock.Mock()
+    ret = mod.FileSlice(fd, 2, 5)
+    fd.seek.assert_called_once_with(2)
+    assert ret.fileno() == fd.fileno.return_value
+    ret.close()
+    assert fd.close.called
+
+
+def test_range_wrapper_prefetch():
+    """
+    Given file descriptor, when prefetch() is called, the first chunk is read
+    from the descriptor, and it's returned by subsequent reads.
+    """
+    fd = io.BytesIO(b'0123456789')
+    ret = mod.RangeWrapper(fd, 2, 6)
+    ret.chunk = 4
+    ret.prefetch()
+    assert fd.tell() == 6
+    assert ret.read(1) == b'2'
+    assert ret.read(3) == b'345'
+    assert ret.read(3) == b'67'
+    assert ret.read() == ''
+
+
+def test_range_wrapper_prefetch_read_all():
+    """
+    Given prefetched data, when read() is called without size, prefetched
+    data and the rest of the range is returned.
+    """
+    fd = io.BytesIO(b'0123456789')
+    ret = mod.RangeWrapper(fd, 2, 6)
+    ret.chunk = 4
+    ret.prefetch()
+    assert ret.read() == b'234567'
+    assert ret.read() == ''
+
+
+def test_range_wrapper_read_negative_size():
+    """
+    Given negative size, read() returns the rest of the range, with or without
+    prefetched data.
+    """
+    fd = io.BytesIO(b'0123456789')
+    ret = mod.RangeWrapper(fd, 2, 6)
+    assert ret.read(-1) == b'234567'
+    assert ret.remaining == 0
+    fd = io.BytesIO(b'0123456789')
+    ret = mod.RangeWrapper(fd, 2, 6)
+    ret.chunk = 3
+    ret.prefetch()
+    assert ret.read(-1) == b'234567'
+    assert ret.read() == ''
+
+
+def test_range_wrapper_prefetch_exact_read():
+    """
+    Given prefetched data, when read() is called with size of prefetched
+    data, no more data is read from file descriptor.
+    """
+    fd = io.BytesIO(b'0123456789')
+    ret = mod.RangeWrapper(fd, 2, 6)
+    ret.chunk = 4
+    ret.prefetch()
+    assert ret.read(4) == b'2345'
+    assert fd.tell() == 6
+    assert ret.read(4) == b'67'
@@ -8,7 +8,9 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
+import io
 import time
+import mimetypes
 import pytest
 
 try:
@@ -40,6 +42,68 @@ def test_format_ts_with_no_args(gmtime):
     assert mod.format_ts() == 'Mon, 01 Jan 2015 00:00:00 GMT'
 
 
+@mock.patch(MOD + '.time.gmtime')
+def test_format_ts_cached(gmtime):
+    """
+    Given the same timestamp (down to a second), format_ts() formats it only
+    once.
+    """
+    mod._timestamp_cache.clear()
+    gmtime.return_value = time.struct_time((2015, 1, 1, 0, 0, 0, 3, 1, 0))
+    assert mod.format_ts(1420070400) == 'Thu, 01 Jan 2015 00:00:00 GMT'
+    assert mod.format_ts(1420070400.5) == 'Thu, 01 Jan 2015 00:00:00 GMT'
+    gmtime.assert_called_once_with(1420070400)
+
+
+def test_format_ts_cache_size():
+    """
+    Given more timestamps than the cache can hold, the cache does not grow
+    beyond its size.
+    """
+    mod._timestamp_cache.clear()
+    for ts in range(mod.TIMESTAMP_CACHE_SIZE + 10):
+        mod.format_ts(ts)
+    assert len(mod._timestamp_cache) <= mod.TIMESTAMP_CACHE_SIZE
+
+
+@mock.patch(MOD + '.time')
+def test_date_now(time_mod):
+    """
+    Given the same current second, date_now() formats current time only once.
+    """
+    mod._date_now = (None, None)
+    time_mod.time.side_effect = [1420070400.2, 1420070400.7, 1420070401.1]
+    time_mod.gmtime.side_effect = time.gmtime
+    assert mod.date_now() == 'Thu, 01 Jan 2015 00:00:00 GMT'
+    assert mod.date_now() == 'Thu, 01 Jan 2015 00:00:00 GMT'
+    assert mod.date_now() == 'Thu, 01 Jan 2015 00:00:01 GMT'
+    assert time_mod.gmtime.call_count == 2
+
+
+def test_guess_type():
+    """
+    Given a filename, guess_type() returns the same value as
+    mimetypes.guess_type().
+    """
+    names = ['foo', 'foo.pdf', 'foo.HTML', 'foo.tar.gz', 'foo.tgz', 'foo.Z',
+             'foo.gz', 'foo.v1/bar', '.bashrc']
+    for name in names:
+        assert mod.guess_type(name) == mimetypes.guess_type(name)
+
+
+@mock.patch(MOD + '.mimetypes.guess_type')
+def test_guess_type_cached(guess_type):
+    """
+    Given filenames with same extension, guess_type() looks up the extension
+    only once.
+    """
+    mod._mimetype_cache.clear()
+    guess_type.return_value = ('application/pdf', None)
+    assert mod.guess_type('foo.pdf') == ('application/pdf', None)
+    assert mod.guess_type('bar.pdf') == ('application/pdf', None)
+    guess_type.assert_called_once_with('file.pdf')
+
+
 def test_send_file_with_wrong_object():
     """
     Given an object that has no 'read' attribute, when calling send_file(),
@@ -184,12 +248,72 @@ def test_send_with_size(HTTPResponse, request):
     """
     fd = mock.Mock()
     request.environ.get.return_value = None
+    size = mod.SMALL_FILE_SIZE + 1
+    mod.send_file(fd, 'foo', size)
+    expected_headers = {
+        'Content-Length': size,
+        'Accept-Ranges': 'bytes',
+    }
+    HTTPResponse.assert_called_once_with(fd, status=200, **expected_headers)
+
+
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.HTTPResponse')
+def test_send_small_file(HTTPResponse, request):
+    """
+    Given a size that is not larger than SMALL_FILE_SIZE, the file is read
+    and closed, and its contents are used as response body.
+    """
+    fd = mock.Mock()
+    fd.read.return_value = b'x' * 200
+    request.environ.get.return_value = None
     mod.send_file(fd, 'foo', 200)
     expected_headers = {
         'Content-Length': 200,
         'Accept-Ranges': 'bytes',
     }
-    HTTPResponse.assert_called_once_with(fd, status=200, **expected_headers)
+    fd.read.assert_called_once_with(200)
+    assert fd.close.called
+    HTTPResponse.assert_called_once_with(fd.read.return_value, status=200,
+                                         **expected_headers)
+
+
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.HTTPResponse')
+def test_send_small_file_short_reads(HTTPResponse, request):
+    """
+    Given a small file whose descriptor returns less data than requested, it
+    is read until the size is reached or it is exhausted, and Content-Length
+    is set to the size of the data that was read.
+    """
+    fd = mock.Mock()
+    fd.read.side_effect = [b'abc', b'de', b'']
+    request.environ.get.return_value = None
+    mod.send_file(fd, 'foo', 200)
+    assert fd.read.call_count == 3
+    assert fd.close.called
+    HTTPResponse.assert_called_once_with(b'abcde', status=200, **{
+        'Content-Length': 5,
+        'Accept-Ranges': 'bytes',
+    })
+
+
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.HTTPResponse')
+def test_head_small_file(HTTPResponse, request):
+    """
+    Given a size that is not larger than SMALL_FILE_SIZE and request method is
+    HEAD, the file is not read.
+    """
+    fd = mock.Mock()
+    request.method = 'HEAD'
+    request.environ.get.return_value = None
+    mod.send_file(fd, 'foo', 200)
+    assert not fd.read.called
+    HTTPResponse.assert_called_once_with('', status=200, **{
+        'Content-Length': 200,
+        'Accept-Ranges': 'bytes',
+    })
 
 
 @mock.patch(MOD + '.request')
@@ -218,6 +342,8 @@ def test_if_modified_since(HTTPResponse, request, getmtime, parse_date):
     created instead of the regular response.  A Date header should be set to
     current timestamp.
     """
+    mod._timestamp_cache.clear()
+    mod._date_now = (None, None)
     fd = mock.Mock()
     timestamp = 1428841333
     modsince = 'Sat, 24 Apr 2015 12:22:14 GMT'
@@ -231,6 +357,7 @@ def test_if_modified_since(HTTPResponse, request, getmtime, parse_date):
         'Date': 'Sun, 19 Apr 2015 16:48:12 GMT',
     }
     HTTPResponse.assert_called_once_with(status=304, **expected_headers)
+    assert fd.close.called
 
 
 @mock.patch(MOD + '.parse_date')
@@ -244,6 +371,7 @@ def test_if_modified_since_stale(HTTPResponse, request, getmtime, parse_date):
     created instead of the regular response.  A Date header should be set to
     current timestamp.
     """
+    mod._timestamp_cache.clear()
     fd = mock.Mock()
     timestamp = 1428841335
     modsince = 'Sat, 24 Apr 2015 12:22:14 GMT'
@@ -258,6 +386,36 @@ def test_if_modified_since_stale(HTTPResponse, request, getmtime, parse_date):
     HTTPResponse.assert_called_once_with(fd, status=200, **expected_headers)
 
 
+@mock.patch(MOD + '.parse_date')
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.HTTPResponse')
+def test_if_modified_since_fractional_timestamp(HTTPResponse, request,
+                                                parse_date):
+    """
+    Given timestamp with fractional seconds and If-Modified-Since request
+    header with the same whole second, HTTP 304 response is created.
+    """
+    fd = mock.Mock()
+    parse_date.return_value = 1428841333
+    request.environ.get.return_value = 'Sun, 12 Apr 2015 12:22:13 GMT'
+    mod.send_file(fd, 'foo', timestamp=1428841333.5)
+    assert HTTPResponse.call_args[1]['status'] == 304
+
+
+@mock.patch(MOD + '.parse_date')
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.HTTPResponse')
+def test_no_if_modified_since(HTTPResponse, request, parse_date):
+    """
+    Given timestamp and no If-Modified-Since request header, the header is
+    not parsed.
+    """
+    fd = mock.Mock()
+    request.environ.get.return_value = None
+    mod.send_file(fd, 'foo', timestamp=1428841333)
+    assert not parse_date.called
+
+
 @mock.patch(MOD + '.request')
 @mock.patch(MOD + '.HTTPResponse')
 def test_head(HTTPResponse, request):
@@ -269,6 +427,29 @@ def test_head(HTTPResponse, request):
     request.method = 'HEAD'
     mod.send_file(fd, 'foo')
     HTTPResponse.assert_called_once_with('', status=200)
+    assert fd.close.called
+
+
+@mock.patch(MOD + '.parse_range_header')
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.HTTPResponse')
+def test_head_range(HTTPResponse, request, parse_range_header):
+    """
+    Given request method is HEAD and valid Range request header, the file
+    descriptor is closed and not wrapped, and range headers are set.
+    """
+    fd = mock.Mock()
+    wrapper = mock.Mock()
+    request.method = 'HEAD'
+    parse_range_header.return_value = ((20, 300),)
+    mod.send_file(fd, 'foo', size=400, wrapper=wrapper)
+    assert fd.close.called
+    assert not wrapper.called
+    HTTPResponse.assert_called_once_with('', status=206, **{
+        'Accept-Ranges': 'bytes',
+        'Content-Length': '280',
+        'Content-Range': 'bytes 20-299/400',
+    })
 
 
 @mock.patch(MOD + '.parse_range_header')
@@ -283,6 +464,7 @@ def test_wrong_range(HTTPError, request, parse_range_header):
     parse_range_header.return_value = []
     mod.send_file(fd, 'foo', size=200)
     HTTPError.assert_called_once_with(416, 'Request Range Not Satisfiable')
+    assert fd.close.called
 
 
 @mock.patch(MOD + '.parse_range_header')
@@ -305,3 +487,119 @@ def test_range_wrapper(HTTPResponse, request, parse_range_header):
     wrapper.assert_called_once_with(fd, 20, 280)
     HTTPResponse.assert_called_once_with(
         wrapper.return_value, status=206, **expected_headers)
+
+
+@mock.patch(MOD + '.request')
+def test_can_sendfile(request):
+    """
+    Given a file descriptor with a file number and a plain HTTP request,
+    can_sendfile() returns True.
+    """
+    fd = mock.Mock()
+    fd.fileno.return_value = 3
+    request.environ = {'wsgi.url_scheme': 'http',
+                       'SERVER_PROTOCOL': 'HTTP/1.1'}
+    assert mod.can_sendfile(fd) is True
+
+
+@mock.patch(MOD + '.request')
+def test_can_sendfile_no_fileno(request):
+    """
+    Given a file descriptor whose fileno() is missing or unsupported,
+    can_sendfile() returns False.
+    """
+    request.environ = {}
+    fd = mock.Mock()
+    fd.fileno.side_effect = io.UnsupportedOperation
+    assert mod.can_sendfile(fd) is False
+    del fd.fileno
+    assert mod.can_sendfile(fd) is False
+
+
+@mock.patch(MOD + '.request')
+def test_can_sendfile_tls_or_http2(request):
+    """
+    Given a HTTPS or HTTP/2 request, can_sendfile() returns False.
+    """
+    fd = mock.Mock()
+    fd.fileno.return_value = 3
+    request.environ = {'wsgi.url_scheme': 'https'}
+    assert mod.can_sendfile(fd) is False
+    request.environ = {'SERVER_PROTOCOL': 'HTTP/2.0'}
+    assert mod.can_sendfile(fd) is False
+
+
+@mock.patch(MOD + '.parse_range_header')
+@mock.patch(MOD + '.can_sendfile')
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.HTTPResponse')
+def test_range_sendfile(HTTPResponse, request, can_sendfile,
+                        parse_range_header):
+    """
+    Given a file descriptor that can be used with sendfile(), when the default
+    wrapper is used, SendfileBody is used to wrap the file descriptor.
+    """
+    fd = mock.Mock()
+    can_sendfile.return_value = True
+    parse_range_header.return_value = ((20, 300),)
+    mod.send_file(fd, 'foo', size=400)
+    body = HTTPResponse.call_args[0][0]
+    assert isinstance(body, mod.SendfileBody)
+    assert body.fd is fd
+    assert body.remaining == 280
+    fd.seek.assert_called_once_with(20)
+
+
+def test_sendfile_body_fileno():
+    """
+    Given a file descriptor, SendfileBody exposes its file number.
+    """
+    fd = mock.Mock()
+    body = mod.SendfileBody(fd, 20, 20)
+    assert body.fileno() == fd.fileno.return_value
+
+
+@mock.patch(MOD + '.parse_range_header')
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.HTTPResponse')
+def test_range_whole_file(HTTPResponse, request, parse_range_header):
+    """
+    Given size and Range request header that covers the entire file, file
+    descriptor is not wrapped, and 206 response is returned.
+    """
+    fd = mock.Mock()
+    wrapper = mock.Mock()
+    parse_range_header.return_value = ((0, 400),)
+    mod.send_file(fd, 'foo', size=400, wrapper=wrapper)
+    expected_headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': '400',
+        'Content-Range': 'bytes 0-399/400',
+    }
+    assert not wrapper.called
+    HTTPResponse.assert_called_once_with(fd, status=206, **expected_headers)
+
+
+@mock.patch(MOD + '.parse_range_header')
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.HTTPResponse')
+def test_range_wrapper_prefetch(HTTPResponse, request, parse_range_header):
+    """
+    Given a wrapper that returns an object with prefetch() method, the method
+    is called before the response is returned.
+    """
+    fd = mock.Mock()
+    wrapper = mock.Mock()
+    parse_range_header.return_value = ((20, 300),)
+    mod.send_file(fd, 'foo', size=400, wrapper=wrapper)
+    assert wrapper.return_value.prefetch.called
+
+
+def test_sendfile_body_prefetch():
+    """
+    Given SendfileBody, prefetch() does not read from file descriptor.
+    """
+    fd = mock.Mock()
+    body = mod.SendfileBody(fd, 20, 20)
+    body.prefetch()
+    assert not fd.read.called
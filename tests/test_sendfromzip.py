@@ -0,0 +1,446 @@
+"""
+test_sendfromzip.py: tests for fdsend.sendfromzip module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import zipfile
+import threading
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pytest
+
+import fdsend.sendfromzip as mod
+
+MOD = mod.__name__
+
+
+@pytest.fixture
+def zippath(tmpdir):
+    path = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('foo/bar.txt', b'hello world')
+    mod._zip_cache.clear()
+    return path
+
+
+def test_lru_cache_get():
+    """
+    Given a key, get() returns stored value, or default if key is missing.
+    """
+    cache = mod.LRUCache(2)
+    cache.add('a', 1)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('b', 2) == 2
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """
+    Given a full cache, when a value is added, least recently used value is
+    removed and passed to on_evict().
+    """
+    on_evict = mock.Mock()
+    cache = mod.LRUCache(2, on_evict)
+    cache.add('a', 1)
+    cache.add('b', 2)
+    cache.get('a')
+    cache.add('c', 3)
+    on_evict.assert_called_once_with(2)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+
+
+def test_lru_cache_add_existing_key():
+    """
+    Given a key that is already in the cache, add() returns the cached value
+    and evicts the new one.
+    """
+    on_evict = mock.Mock()
+    cache = mod.LRUCache(2, on_evict)
+    cache.add('a', 1)
+    assert cache.add('a', 2) == 1
+    on_evict.assert_called_once_with(2)
+
+
+def test_lru_cache_clear():
+    """
+    Given a cache with values, clear() evicts all of them.
+    """
+    on_evict = mock.Mock()
+    cache = mod.LRUCache(2, on_evict)
+    cache.add('a', 1)
+    cache.add('b', 2)
+    cache.clear()
+    on_evict.assert_has_calls([mock.call(1), mock.call(2)])
+    assert cache.get('a') is None
+
+
+def test_lru_cache_acquire():
+    """
+    Given an acquired value that is removed from the cache, it is evicted only
+    once it is released by all of its users.
+    """
+    on_evict = mock.Mock()
+    cache = mod.LRUCache(1, on_evict)
+    cache.add('a', 1)
+    assert cache.acquire('a') == 1
+    assert cache.acquire('a') == 1
+    assert cache.acquire('b') is None
+    cache.add('b', 2)
+    assert not on_evict.called
+    cache.release(1)
+    assert not on_evict.called
+    cache.release(1)
+    on_evict.assert_called_once_with(1)
+
+
+def test_lru_cache_add_acquire():
+    """
+    Given acquire flag, add() marks the returned value as in use.
+    """
+    on_evict = mock.Mock()
+    cache = mod.LRUCache(1, on_evict)
+    assert cache.add('a', 1, acquire=True) == 1
+    cache.clear()
+    assert not on_evict.called
+    cache.release(1)
+    on_evict.assert_called_once_with(1)
+
+
+def test_open_zip_cached(zippath):
+    """
+    Given the same archive path, open_zip() returns the same ZipFile object,
+    and modification time of the archive.
+    """
+    zfile, timestamp = mod.open_zip(zippath)
+    assert isinstance(zfile, zipfile.ZipFile)
+    assert timestamp == os.path.getmtime(zippath)
+    assert mod.open_zip(zippath)[0] is zfile
+    mod.release_zip(zfile)
+    mod.release_zip(zfile)
+
+
+@mock.patch(MOD + '._zip_cache', mod.LRUCache(1, lambda z: z.close()))
+def test_open_zip_evicted_in_use(zippath, tmpdir):
+    """
+    Given an archive that is in use, when it drops out of the cache, it is not
+    closed until it is released.
+    """
+    other = str(tmpdir.join('other.zip'))
+    with zipfile.ZipFile(other, 'w') as z:
+        z.writestr('foo.txt', b'foo')
+    zfile, _ = mod.open_zip(zippath)
+    other_zfile, _ = mod.open_zip(other)
+    mod.release_zip(other_zfile)
+    with zfile.open('foo/bar.txt') as f:
+        assert f.read() == b'hello world'
+    mod.release_zip(zfile)
+    assert zfile.fp is None
+
+
+def test_open_zip_modified(zippath):
+    """
+    Given an archive that has been modified, open_zip() opens it again.
+    """
+    zfile, _ = mod.open_zip(zippath)
+    st = os.stat(zippath)
+    os.utime(zippath, (st.st_atime, st.st_mtime + 10))
+    new_zfile, timestamp = mod.open_zip(zippath)
+    assert new_zfile is not zfile
+    assert timestamp == st.st_mtime + 10
+    mod.release_zip(zfile)
+    mod.release_zip(new_zfile)
+
+
+@mock.patch(MOD + '.send_file')
+def test_send_from_zip(send_file, zippath):
+    """
+    Given archive path and path of a file within it, send_file() is called
+    with a file descriptor for the file and its metadata.
+    """
+    ret = mod.send_from_zip(zippath, 'foo/bar.txt', attachment=True)
+    assert ret == send_file.return_value
+    fd = send_file.call_args[0][0]
+    assert fd.read() == b'hello world'
+    send_file.assert_called_once_with(
+        fd, filename='bar.txt', size=11,
+        timestamp=os.path.getmtime(zippath), ctype=None,
+        charset=mod.CHARSET, attachment=True, wrapper=mod.DEFAULT_WRAPPER)
+
+
+@mock.patch(MOD + '.HTTPError')
+def test_send_from_zip_missing(HTTPError, zippath):
+    """
+    Given a path that does not exist in the archive, HTTP 404 error is
+    returned.
+    """
+    ret = mod.send_from_zip(zippath, 'missing.txt')
+    HTTPError.assert_called_once_with(404, 'Not Found')
+    assert ret == HTTPError.return_value
+
+
+@mock.patch(MOD + '.send_file')
+def test_send_from_zip_stored(send_file, tmpdir):
+    """
+    Given a file stored in the archive without compression, send_file() is
+    called with a file slice of the archive file.
+    """
+    path = str(tmpdir.join('stored.zip'))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as z:
+        z.writestr('foo.txt', b'foo')
+        z.writestr('bar.txt', b'hello world')
+    mod.send_from_zip(path, 'bar.txt')
+    fd = send_file.call_args[0][0]
+    assert isinstance(fd, mod.FileSlice)
+    assert fd.read() == b'hello world'
+    assert send_file.call_args[1]['size'] == 11
+    fd.close()
+
+
+def test_open_stored_bad_header(tmpdir):
+    """
+    Given archive member information that does not point to a valid local
+    file header, open_stored() returns None.
+    """
+    path = str(tmpdir.join('stored.zip'))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as z:
+        z.writestr('foo.txt', b'foo')
+    zinfo = zipfile.ZipInfo('foo.txt')
+    zinfo.header_offset = 5
+    assert mod.open_stored(path, zinfo) is None
+
+
+def test_spill(zippath, tmpdir):
+    """
+    Given archive member, spill() decompresses it into a file in SPILL_DIR
+    and returns the file's path.
+    """
+    zfile, _ = mod.open_zip(zippath)
+    with mock.patch(MOD + '.SPILL_DIR', str(tmpdir)):
+        path = mod.spill(zfile, zfile.getinfo('foo/bar.txt'))
+    assert os.path.dirname(path) == str(tmpdir)
+    with open(path, 'rb') as f:
+        assert f.read() == b'hello world'
+
+
+def test_open_spilled_reuses_spill_file(zippath):
+    """
+    Given the same archive member, open_spilled() decompresses it only once
+    and the spill file is removed when the cache is cleared.
+    """
+    mod._spill_cache.clear()
+    zfile, _ = mod.open_zip(zippath)
+    zinfo = zfile.getinfo('foo/bar.txt')
+    with mock.patch(MOD + '.spill', wraps=mod.spill) as spill:
+        fd1 = mod.open_spilled(zfile, zinfo)
+        fd2 = mod.open_spilled(zfile, zinfo)
+    assert spill.call_count == 1
+    assert fd1.name == fd2.name
+    assert fd2.read() == b'hello world'
+    fd1.close()
+    fd2.close()
+    mod._spill_cache.clear()
+    assert not os.path.exists(fd1.name)
+
+
+def test_open_spilled_concurrent(zippath):
+    """
+    Given several threads that open the same archive member at once, the
+    member is decompressed only once.
+    """
+    mod._spill_cache.clear()
+    zfile, _ = mod.open_zip(zippath)
+    zinfo = zfile.getinfo('foo/bar.txt')
+    started = threading.Event()
+    proceed = threading.Event()
+    real_spill = mod.spill
+
+    def slow_spill(*args):
+        started.set()
+        proceed.wait(5)
+        return real_spill(*args)
+
+    results = []
+
+    def worker():
+        fd = mod.open_spilled(zfile, zinfo)
+        results.append(fd.read())
+        fd.close()
+
+    with mock.patch(MOD + '.spill', side_effect=slow_spill) as spill:
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        proceed.set()
+        for thread in threads:
+            thread.join()
+    assert spill.call_count == 1
+    assert results == [b'hello world'] * 4
+    assert not mod._spill_locks
+    mod._spill_cache.clear()
+
+
+@mock.patch(MOD + '.SPILL_THRESHOLD', 10)
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.send_file')
+def test_send_from_zip_range_spilled(send_file, request, zippath):
+    """
+    Given a Range request for a compressed file that is at least
+    SPILL_THRESHOLD bytes large, send_file() is called with a decompressed
+    copy of the file.
+    """
+    mod._spill_cache.clear()
+    request.environ = {'HTTP_RANGE': 'bytes=6-'}
+    mod.send_from_zip(zippath, 'foo/bar.txt')
+    fd = send_file.call_args[0][0]
+    assert fd.fileno()
+    assert fd.read() == b'hello world'
+    fd.close()
+    mod._spill_cache.clear()
+
+
+@mock.patch(MOD + '.SPILL_DIR', '/nonexistent')
+@mock.patch(MOD + '.SPILL_THRESHOLD', 10)
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.send_file')
+def test_send_from_zip_spill_fails(send_file, request, zippath):
+    """
+    Given a Range request for a compressed file that cannot be spilled,
+    send_file() is called with the archive member itself.
+    """
+    mod._spill_cache.clear()
+    request.environ = {'HTTP_RANGE': 'bytes=6-'}
+    mod.send_from_zip(zippath, 'foo/bar.txt')
+    fd = send_file.call_args[0][0]
+    assert isinstance(fd, zipfile.ZipExtFile)
+    assert fd.read() == b'hello world'
+
+
+@mock.patch(MOD + '.SPILL_THRESHOLD', 10)
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.send_file')
+def test_send_from_zip_no_range_not_spilled(send_file, request, zippath):
+    """
+    Given a request without Range header, compressed file is not spilled.
+    """
+    request.environ = {}
+    mod.send_from_zip(zippath, 'foo/bar.txt')
+    fd = send_file.call_args[0][0]
+    assert isinstance(fd, zipfile.ZipExtFile)
+
+
+@mock.patch(MOD + '.SPILL_THRESHOLD', 10)
+@mock.patch(MOD + '.spill')
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.send_file')
+def test_send_from_zip_range_not_modified(send_file, request, spill,
+                                          zippath):
+    """
+    Given a Range request for a compressed file that has not been modified
+    since the time in If-Modified-Since header, the file is not spilled.
+    """
+    mod._spill_cache.clear()
+    request.environ = {
+        'HTTP_RANGE': 'bytes=6-',
+        'HTTP_IF_MODIFIED_SINCE': 'Fri, 01 Jan 2100 00:00:00 GMT',
+    }
+    mod.send_from_zip(zippath, 'foo/bar.txt')
+    assert not spill.called
+    fd = send_file.call_args[0][0]
+    assert isinstance(fd, zipfile.ZipExtFile)
+
+
+@mock.patch(MOD + '.SPILL_THRESHOLD', 10)
+@mock.patch(MOD + '.spill')
+@mock.patch(MOD + '.request')
+@mock.patch(MOD + '.send_file')
+def test_send_from_zip_range_head_not_spilled(send_file, request, spill,
+                                              zippath):
+    """
+    Given a HEAD request with Range header for a compressed file, the file is
+    not spilled.
+    """
+    mod._spill_cache.clear()
+    request.method = 'HEAD'
+    request.environ = {'HTTP_RANGE': 'bytes=6-'}
+    mod.send_from_zip(zippath, 'foo/bar.txt')
+    assert not spill.called
+
+
+@mock.patch(MOD + '.SPILL_THRESHOLD', 10)
+@mock.patch(MOD + '.open_spilled')
+def test_prefill_spills(open_spilled, tmpdir):
+    """
+    Given an archive, prefill_spills() creates spill files for compressed
+    members of at least SPILL_THRESHOLD bytes.
+    """
+    path = str(tmpdir.join('mixed.zip'))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('small.txt', b'foo')
+        z.writestr('large.txt', b'hello world')
+        z.writestr('stored.txt', b'hello world', zipfile.ZIP_STORED)
+    mod.prefill_spills(path, workers=2)
+    zfile, _ = mod.open_zip(path)
+    open_spilled.assert_called_once_with(zfile, zfile.getinfo('large.txt'))
+    assert open_spilled.return_value.close.called
+
+
+@mock.patch(MOD + '.SPILL_CACHE_SIZE', 2)
+@mock.patch(MOD + '.SPILL_THRESHOLD', 1)
+@mock.patch(MOD + '.open_spilled')
+def test_prefill_spills_cache_size(open_spilled, tmpdir):
+    """
+    Given an archive with more large compressed members than SPILL_CACHE_SIZE,
+    prefill_spills() creates spill files only for the largest ones.
+    """
+    path = str(tmpdir.join('many.zip'))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('a.txt', b'a')
+        z.writestr('b.txt', b'bbb')
+        z.writestr('c.txt', b'cc')
+    mod.prefill_spills(path, workers=1)
+    zfile, _ = mod.open_zip(path)
+    open_spilled.assert_has_calls([
+        mock.call(zfile, zfile.getinfo('b.txt')),
+        mock.call(zfile, zfile.getinfo('c.txt')),
+    ], any_order=True)
+    assert open_spilled.call_count == 2
+
+
+@mock.patch(MOD + '.open_spilled')
+def test_prefill_spills_paths(open_spilled, tmpdir):
+    """
+    Given paths of archive members, prefill_spills() creates spill files for
+    those members that are compressed, regardless of their size.
+    """
+    path = str(tmpdir.join('mixed.zip'))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('small.txt', b'foo')
+        z.writestr('stored.txt', b'hello world', zipfile.ZIP_STORED)
+    mod.prefill_spills(path, ['small.txt', 'stored.txt'])
+    zfile, _ = mod.open_zip(path)
+    open_spilled.assert_called_once_with(zfile, zfile.getinfo('small.txt'))
+
+
+@mock.patch(MOD + '.open_spilled')
+def test_prefill_spills_error(open_spilled, zippath):
+    """
+    Given a member that cannot be decompressed, prefill_spills() raises the
+    error once all members are processed.
+    """
+    open_spilled.side_effect = zipfile.BadZipfile('bad')
+    with pytest.raises(zipfile.BadZipfile):
+        mod.prefill_spills(zippath, ['foo/bar.txt'])
+    assert open_spilled.call_count == 1